@@ -1,91 +1,253 @@
 #!/usr/bin/env python3
+import asyncio
+import functools
+import itertools
 import json
 import math
+import os
 import re
-import statistics
+import shlex
 import subprocess
 import sys
+import tempfile
 
 from argparse import ArgumentParser
+from collections import deque
+from operator import attrgetter
 from pathlib import Path
+from statistics import NormalDist
 
 from typing import (
-    Iterable, Dict, Any, Optional, Callable, TypeVar, Tuple, Union
+    TYPE_CHECKING, List, Dict, Any, Optional, Tuple, Union
 )
 
 import attr
-import humanfriendly
-import scipy.stats as stats
 
+if TYPE_CHECKING:
+    import numpy as np
 
-def ffprobe(path: Path) -> Dict[str, Any]:
-    result = subprocess.check_output([
+
+async def ffprobe_duration(path: Path, limit: asyncio.Semaphore) -> float:
+    # only ask for the one field we use; the default writer with no keys or
+    # section wrappers prints just the bare value
+    args = [
         'ffprobe',
         '-loglevel', 'quiet',
-        '-print_format', 'json', '-show_format',
+        '-show_entries', 'format=duration',
+        '-print_format', 'default=noprint_wrappers=1:nokey=1',
         str(path)
-    ])
+    ]
+
+    async with limit:
+        print('checking: ', path, file=sys.stderr)
+        proc = await asyncio.create_subprocess_exec(
+            *args, stdout=subprocess.PIPE
+        )
+        result, _ = await proc.communicate()
 
-    return json.loads(result)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(
+            proc.returncode, args, output=result
+        )
+
+    return float(result.strip())
 
 
 @attr.s()
+class ProbeCache(object):
+    # abs path -> {'size', 'mtime_ns', 'duration'}; an entry is only reused if
+    # the size and mtime still match the file on disk
+    path: Path = attr.ib()
+    entries: Dict[str, Any] = attr.ib(factory=dict)
+    dirty: bool = attr.ib(default=False)
+
+    @classmethod
+    def default_path(cls) -> Path:
+        cache_home = os.environ.get('XDG_CACHE_HOME')
+        if cache_home:
+            base = Path(cache_home)
+        else:
+            base = Path.home() / '.cache'
+
+        return base / 'renamer' / 'probe.json'
+
+    @classmethod
+    def load(cls, path: Path) -> 'ProbeCache':
+        try:
+            with path.open() as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+
+        if not isinstance(entries, dict):
+            entries = {}
+
+        return ProbeCache(path=path, entries=entries)
+
+    def get(self, key: str, stat: os.stat_result) -> Optional[float]:
+        # anything malformed is just treated as a miss and re-probed
+        cached = self.entries.get(key)
+        if not isinstance(cached, dict):
+            return None
+
+        if cached.get('size') != stat.st_size \
+                or cached.get('mtime_ns') != stat.st_mtime_ns:
+            return None
+
+        duration = cached.get('duration')
+        if not isinstance(duration, (int, float)) or isinstance(duration, bool):
+            return None
+
+        return float(duration)
+
+    def put(self, key: str, stat: os.stat_result, duration: float):
+        self.entries[key] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'duration': duration
+        }
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+            # write to a uniquely named temp file first so an interrupted
+            # save, or another renamer saving at the same time, can't leave
+            # a truncated or interleaved cache behind
+            with tempfile.NamedTemporaryFile(
+                'w',
+                dir=str(self.path.parent),
+                prefix=self.path.name + '.',
+                suffix='.tmp',
+                delete=False
+            ) as f:
+                tmp_path = f.name
+                try:
+                    json.dump(self.entries, f)
+                except BaseException:
+                    f.close()
+                    os.unlink(tmp_path)
+                    raise
+
+            os.replace(tmp_path, str(self.path))
+        except OSError as e:
+            print('warning: could not save probe cache:', e, file=sys.stderr)
+
+
+@attr.s(slots=True, frozen=True)
 class Entry(object):
     abs_path: Path = attr.ib()
     rel_path: Path = attr.ib()
     size: int = attr.ib()
     duration: float = attr.ib()
 
+    # derived from rel_path once up front since both are used per-entry when
+    # matching and renaming
+    rel_path_str: str = attr.ib()
+    extension: str = attr.ib()
+
     @classmethod
-    def new(cls, abs_path: Path) -> 'Entry':
+    async def new(
+        cls,
+        abs_path: Path,
+        stat: os.stat_result,
+        limit: asyncio.Semaphore,
+        cache: ProbeCache
+    ) -> 'Entry':
         rel_path = abs_path.relative_to(abs_path.parent.parent)
-        stat = abs_path.stat()
-        print('checking: ', abs_path, file=sys.stderr)
-        probe = ffprobe(abs_path)
 
-        duration = float(probe['format']['duration'])
+        # abspath() doesn't touch the filesystem; size and mtime are enough
+        # to catch stale entries without resolving symlinks
+        cache_key = os.path.abspath(str(abs_path))
+        duration = cache.get(cache_key, stat)
+        if duration is None:
+            duration = await ffprobe_duration(abs_path, limit)
+            cache.put(cache_key, stat, duration)
 
         return Entry(
             abs_path=abs_path,
             rel_path=rel_path,
             size=stat.st_size,
-            duration=duration
+            duration=duration,
+            rel_path_str=str(rel_path),
+            extension=''.join(rel_path.suffixes)
         )
 
 
-def scan(directory: Path) -> Iterable[Entry]:
-    for entry in directory.iterdir():
-        if not entry.is_file():
-            continue
+async def scan(
+    directory: Path,
+    limit: asyncio.Semaphore,
+    cache: ProbeCache
+) -> List[Entry]:
+    # scandir's DirEntry caches the stat result, so each file is only
+    # stat'd once between the is_file() check and Entry.new()
+    files = []
+    with os.scandir(str(directory)) as it:
+        for dir_entry in it:
+            if not dir_entry.is_file():
+                continue
+
+            files.append((Path(dir_entry.path), dir_entry.stat()))
 
-        yield Entry.new(entry)
+    return await asyncio.gather(*(
+        Entry.new(path, stat, limit, cache) for path, stat in files
+    ))
 
 
-T = TypeVar('T')
+async def scan_all(
+    directories: List[Path],
+    jobs: int,
+    cache: ProbeCache
+) -> List[List[Entry]]:
+    # bounds the number of ffprobe processes (and their pipes) in flight
+    # across all directories
+    limit = asyncio.Semaphore(jobs)
+
+    return await asyncio.gather(*(
+        scan(d, limit, cache) for d in directories
+    ))
 
 
 def confidence_interval(
-    entries: Iterable[T],
-    confidence: float,
-    key: Optional[Callable[[T], float]]
+    values: 'np.ndarray',
+    confidence: float
 ) -> Tuple[float, float]:
-    if key is None:
-        key = float
-
-    entries = [key(e) for e in entries]
-    
-    mean = statistics.mean(entries)
-    stdev = statistics.stdev(entries, xbar=mean)
+    if len(values) == 0:
+        raise ValueError('no durations to calculate an interval from')
+
+    mean = values.mean()
+    if len(values) < 2:
+        # the sample stdev is undefined for a single value; treat it as
+        # exact rather than letting nan reach the duration filters
+        stdev = 0.0
+    else:
+        # values.std() would compute the mean again internally, so derive
+        # the sample stdev from the deviations around the mean we already
+        # have
+        deviations = values - mean
+        stdev = math.sqrt(deviations @ deviations / (len(values) - 1))
 
     # halve confidence to get 0-100% range (1-tailed interval rather than 2)
     confidence = 1 - ((1 - confidence) / 2)
-    z = stats.norm.ppf(confidence)
+    if confidence < 1:
+        z = NormalDist().inv_cdf(confidence)
+    else:
+        # inv_cdf(1) is undefined; the interval is unbounded
+        z = math.inf
 
-    ci_size = z * (stdev / math.sqrt(len(entries)))
-    print('n:', len(entries), 'mean:', mean / 60, 'stdev:', stdev / 60, 'ci_size:', ci_size / 60)
+    # z may be infinite; no spread still means no interval (not inf * 0)
+    if stdev > 0:
+        ci_size = z * (stdev / math.sqrt(len(values)))
+    else:
+        ci_size = 0.0
+    print('n:', len(values), 'mean:', mean / 60, 'stdev:', stdev / 60, 'ci_size:', ci_size / 60)
 
     lower = max(0, mean - ci_size)
-    upper = min(max(entries), mean + ci_size)
+    upper = min(values.max(), mean + ci_size)
 
     return lower, upper
 
@@ -107,18 +269,60 @@ def ranged_float(v_min: float, v_max: float) -> float:
     return ret
 
 
+def positive_int(v: str) -> int:
+    i = int(v)
+    if i < 1:
+        raise ValueError('value must be at least 1: {}'.format(v))
+
+    return i
+
+
+@functools.lru_cache(maxsize=1024)
 def maybe_convert_int(s: str) -> Union[int, str]:
-    try:
-        # try to convert and see what happens
+    # check up front rather than catching ValueError, since most captures
+    # (titles, etc) won't be numeric; isdecimal() only accepts characters
+    # int() can parse
+    if s and (s.isdecimal() or (s[0] == '-' and s[1:].isdecimal())):
         conv = int(s)
 
         # make sure the human-readable value hasn't changed
         if str(conv) == s:
             return conv
-        else:
-            return  s
-    except ValueError:
-        return s
+
+    return s
+
+
+def write_lines(fd: int, lines: List[bytes]):
+    """Writes all of `lines` to `fd`, resuming after any short writes."""
+    if not hasattr(os, 'writev'):
+        data = memoryview(b''.join(lines))
+        while data:
+            data = data[os.write(fd, data):]
+
+        return
+
+    try:
+        iov_max = os.sysconf('SC_IOV_MAX')
+    except (ValueError, OSError):
+        iov_max = -1
+
+    if iov_max <= 0:
+        iov_max = 1024
+
+    pending = deque(memoryview(line) for line in lines if line)
+    while pending:
+        written = os.writev(fd, list(itertools.islice(pending, iov_max)))
+
+        # writev may stop short (e.g. on a full pipe), so drop whatever was
+        # written and retry from there
+        while written:
+            head = pending[0]
+            if written < len(head):
+                pending[0] = head[written:]
+                break
+
+            written -= len(head)
+            pending.popleft()
 
 
 def main():
@@ -181,27 +385,55 @@ def main():
              '--confidence setting'
     )
 
+    parser.add_argument(
+        '--probe-jobs', '--probe-threads',
+        type=positive_int,
+        default=min(32, (os.cpu_count() or 1) * 4),
+        help='number of ffprobe processes to run concurrently'
+    )
+
     args = parser.parse_args()
 
+    # deferred so e.g. `--help` doesn't pay for the imports
+    import humanfriendly
+    import numpy as np
+
+    cache = ProbeCache.load(ProbeCache.default_path())
+    try:
+        scanned = asyncio.run(
+            scan_all(args.directories, args.probe_jobs, cache)
+        )
+    finally:
+        # keep whatever was probed even if the scan failed partway through
+        cache.save()
+
     files = []
-    for d in args.directories:
-        entries = sorted(sorted(scan(d), key=lambda e: str(e.rel_path)))
+    for entries in scanned:
+        entries = sorted(entries, key=attrgetter('rel_path'))
         if args.exclude_after:
             entries = entries[:args.exclude_after + 1]
 
         files.extend(entries)
     
     if args.exclude:
-        for exclude in args.exclude:
-            files = [
-                e for e in files
-                if not e.rel_path.match(exclude)
-            ]
+        files = [
+            e for e in files
+            if not any(e.rel_path.match(exclude) for exclude in args.exclude)
+        ]
+
+    if not files:
+        print('error: no files found to rename', file=sys.stderr)
+        sys.exit(1)
+
+    # durations are kept in one contiguous array, parallel to `files`, for
+    # both the interval calculation and the filtering below
+    durations = np.fromiter(
+        (e.duration for e in files), dtype=np.float64, count=len(files)
+    )
 
     duration_lower, duration_upper = confidence_interval(
-        entries=files,
-        confidence=args.confidence,
-        key=lambda e: e.duration,
+        values=durations,
+        confidence=args.confidence
     )
 
     print('duration interval: {:.2f}min - {:.2f}min'.format(
@@ -224,7 +456,7 @@ def main():
             file=sys.stderr
         )
 
-    keep = [e for e in files if e.duration >= minimum_duration]
+    mask = durations >= minimum_duration
 
     if args.max:
         print(
@@ -232,7 +464,9 @@ def main():
             humanfriendly.format_timespan(duration_upper),
             file=sys.stderr
         )
-        keep = [e for e in keep if e.duration <= duration_upper]
+        mask &= durations <= duration_upper
+
+    keep = [files[i] for i in np.flatnonzero(mask)]
 
     for i, entry in enumerate(keep):
         print('{:3} {} {}'.format(
@@ -269,8 +503,18 @@ def main():
         format_kwargs = {}
 
         if input_regex:
-            m = input_regex.match(str(entry.rel_path))
+            m = input_regex.match(entry.rel_path_str)
             if m:
+                # an optional group that didn't participate in the match has
+                # no sensible value to put in the output path
+                if None in m.groups():
+                    print(
+                        'error: not all --input-regex groups matched:',
+                        entry.rel_path,
+                        file=sys.stderr
+                    )
+                    sys.exit(1)
+
                 format_args = [
                     maybe_convert_int(g) for g in m.groups()
                 ]
@@ -283,7 +527,7 @@ def main():
         format_kwargs.update({
             'index': args.offset + i,
             'offset_index': args.offset + i + 1,
-            'extension': ''.join(entry.rel_path.suffixes)
+            'extension': entry.extension
         })
         
         new_path = Path(output_format.format(*format_args, **format_kwargs))
@@ -293,19 +537,36 @@ def main():
         
         paths.append((entry.abs_path, new_path))
     
-    # find all parent dirs
+    # find all parent dirs; most outputs share a parent so only check each
+    # one once
+    checked: Dict[Path, bool] = {}
     dirs = set()
     for _, dest in paths:
-        if not dest.parent.is_dir():
-            dirs.add(str(dest.parent))
+        parent = dest.parent
+        exists = checked.get(parent)
+        if exists is None:
+            exists = parent.is_dir()
+            checked[parent] = exists
+
+        if not exists:
+            dirs.add(str(parent))
     
+    # build the whole script up front and emit it in as few writes as
+    # possible; fsencode keeps any undecodable filename bytes intact
+    lines = []
     for dir_name in dirs:
-        print('mkdir -p \'{}\''.format(dir_name))
-    
+        lines.append(os.fsencode('mkdir -p {}\n'.format(
+            shlex.quote(dir_name)
+        )))
+
     for src, dest in paths:
-        print('mv \'{}\' \'{}\''.format(
-            str(src), str(dest)
-        ))
+        lines.append(os.fsencode('mv {} {}\n'.format(
+            shlex.quote(str(src)), shlex.quote(str(dest))
+        )))
+
+    # make sure anything print()ed earlier comes out first
+    sys.stdout.flush()
+    write_lines(sys.stdout.fileno(), lines)
 
 
 if __name__ == '__main__':